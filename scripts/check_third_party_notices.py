@@ -5,31 +5,35 @@ import subprocess
 import sys
 from pathlib import Path
 
+from generate_third_party_notices import NOTICE_PATH, generate
+
 ROOT = Path(__file__).resolve().parents[1]
 
 
-def run(cmd: list[str]) -> subprocess.CompletedProcess[str]:
-    return subprocess.run(cmd, cwd=ROOT, text=True, capture_output=True)
+def start(cmd: list[str]) -> subprocess.Popen[str]:
+    return subprocess.Popen(cmd, cwd=ROOT, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
 def main() -> int:
-    gen = run([sys.executable, "scripts/generate_third_party_notices.py"])
-    sys.stdout.write(gen.stdout)
-    sys.stderr.write(gen.stderr)
-    if gen.returncode != 0:
-        return gen.returncode
+    generate(ROOT)
+    print(f"Generated {NOTICE_PATH} and LICENSES/*.txt")
+    sys.stdout.flush()
+
+    # Both git queries are read-only and independent, so run them side by side.
+    diff = start(["git", "diff", "--exit-code", "--", "THIRD_PARTY_NOTICES.md", "LICENSES"])
+    others = start(["git", "ls-files", "--others", "--exclude-standard", "THIRD_PARTY_NOTICES.md", "LICENSES"])
+    diff_out, diff_err = diff.communicate()
+    others_out, _ = others.communicate()
 
-    diff = run(["git", "diff", "--exit-code", "--", "THIRD_PARTY_NOTICES.md", "LICENSES"])
     if diff.returncode != 0:
         print("[ERROR] THIRD_PARTY_NOTICES.md and/or LICENSES are out of date. Run generator and commit changes.")
-        sys.stdout.write(diff.stdout)
-        sys.stderr.write(diff.stderr)
+        sys.stdout.write(diff_out)
+        sys.stderr.write(diff_err)
         return 1
 
-    others = run(["git", "ls-files", "--others", "--exclude-standard", "THIRD_PARTY_NOTICES.md", "LICENSES"])
-    if others.returncode == 0 and others.stdout.strip():
+    if others.returncode == 0 and others_out.strip():
         print("[ERROR] Untracked notices/license files detected:")
-        print(others.stdout.strip())
+        print(others_out.strip())
         return 1
 
     print("[OK] THIRD_PARTY_NOTICES and LICENSES are present and up-to-date.")
@@ -2,16 +2,39 @@
 from __future__ import annotations
 
 import argparse
-import json
+import base64
+import functools
+import http.client
+import io
+import os
 import re
+import threading
+import time
+import urllib.parse
 import urllib.request
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterator
 
 ROOT = Path(__file__).resolve().parents[1]
 NOTICE_PATH = ROOT / "THIRD_PARTY_NOTICES.md"
 LICENSES_DIR = ROOT / "LICENSES"
+CACHE_DIR = ROOT / ".cache/nuspec"
+NUGET_HOST = "api.nuget.org"
+MAX_FETCH_WORKERS = 16
+FETCH_TIMEOUT = 20
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.3
+UNSAFE_FILE_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+# ASCII bytes that str.isspace() treats as whitespace (bytes.isspace() misses \x1c-\x1f).
+STR_WHITESPACE_BYTES = frozenset(b for b in range(0x80) if chr(b).isspace())
+
+# One keep-alive HTTPS connection per fetch worker, so the pool never grows past MAX_FETCH_WORKERS.
+_connections = threading.local()
+_open_connections: list[http.client.HTTPSConnection] = []
+_open_connections_lock = threading.Lock()
 
 LICENSE_FILE_CANDIDATES = [
     "LICENSE",
@@ -41,51 +64,129 @@ def parse_args() -> argparse.Namespace:
     return p.parse_args()
 
 
+def local_name(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def iter_csproj_files(directory: str) -> Iterator[str]:
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_csproj_files(entry.path)
+            elif entry.name.lower().endswith(".csproj"):
+                yield entry.path
+
+
 def read_csproj_packages(root: Path) -> list[tuple[str, str]]:
     packages: set[tuple[str, str]] = set()
-    for csproj in root.glob("src/**/*.csproj"):
-        tree = ET.parse(csproj)
-        for node in tree.findall(".//PackageReference"):
-            include = node.attrib.get("Include")
-            version = node.attrib.get("Version") or (node.findtext("Version") or "")
-            if include and version:
-                packages.add((include.strip(), version.strip()))
+    src = root / "src"
+    csprojs = iter_csproj_files(str(src)) if src.is_dir() else ()
+    for csproj in csprojs:
+        with open(csproj, "rb") as f:
+            data = f.read()
+        if b"PackageReference" not in data:
+            continue
+        # Stream the project and clear each element once it closes so the tree is never kept around.
+        # <Version> is left intact until its enclosing PackageReference has read it.
+        for _, node in ET.iterparse(io.BytesIO(data), events=("end",)):
+            tag = local_name(node.tag)
+            if tag == "Version":
+                continue
+            if tag == "PackageReference":
+                include = node.attrib.get("Include")
+                version = node.attrib.get("Version") or next(
+                    (child.text or "" for child in node if local_name(child.tag) == "Version"), ""
+                )
+                if include and version:
+                    packages.add((include.strip(), version.strip()))
+            node.clear()
     return sorted(packages, key=lambda x: (x[0].lower(), x[1]))
 
 
-def fetch_nuspec_metadata(package_id: str, version: str) -> dict[str, str]:
-    package_l = package_id.lower()
-    version_l = version.lower()
-    url = f"https://api.nuget.org/v3-flatcontainer/{package_l}/{version_l}/{package_l}.nuspec"
-    try:
-        with urllib.request.urlopen(url, timeout=20) as resp:
+def nuget_connection() -> http.client.HTTPSConnection:
+    conn = getattr(_connections, "conn", None)
+    if conn is not None:
+        return conn
+
+    # Honour HTTPS_PROXY/NO_PROXY the same way urllib.request.urlopen does.
+    proxy = urllib.request.getproxies().get("https")
+    if proxy and not urllib.request.proxy_bypass(NUGET_HOST):
+        parts = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        port = parts.port or http.client.HTTPSConnection.default_port
+        conn = http.client.HTTPSConnection(parts.hostname, port, timeout=FETCH_TIMEOUT)
+        headers = {}
+        if parts.username:
+            creds = f"{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or '')}"
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(creds.encode("utf-8")).decode("ascii")
+        conn.set_tunnel(NUGET_HOST, headers=headers)
+    else:
+        conn = http.client.HTTPSConnection(NUGET_HOST, timeout=FETCH_TIMEOUT)
+
+    _connections.conn = conn
+    with _open_connections_lock:
+        _open_connections.append(conn)
+    return conn
+
+
+def close_connections() -> None:
+    with _open_connections_lock:
+        for conn in _open_connections:
+            conn.close()
+        _open_connections.clear()
+
+
+def nuget_get(path: str) -> bytes:
+    conn = nuget_connection()
+    url = f"https://{NUGET_HOST}{path}"
+
+    # One initial attempt plus up to FETCH_RETRIES retries.
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
             data = resp.read()
-    except Exception:
-        return {
-            "license_name": "UNKNOWN",
-            "license_url": "",
-            "homepage": "",
-            "notes": "Unable to fetch nuspec metadata from nuget.org in this environment.",
-        }
-
-    root = ET.fromstring(data)
-
-    def txt(xpath: str) -> str:
-        node = root.find(xpath)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if attempt == FETCH_RETRIES:
+                raise
+            time.sleep(FETCH_BACKOFF * (2**attempt))
+            continue
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+            # Redirects are rare and may leave nuget.org, so let urllib follow them.
+            location = urllib.parse.urljoin(url, resp.getheader("Location"))
+            with urllib.request.urlopen(location, timeout=FETCH_TIMEOUT) as redirected:
+                return redirected.read()
+        if resp.status != 200:
+            raise OSError(f"GET {url} returned HTTP {resp.status}")
+        return data
+    raise AssertionError("unreachable")
+
+
+def parse_nuspec_metadata(data: bytes) -> dict[str, str]:
+    # Everything we read lives under <metadata>, so stop parsing as soon as it closes.
+    metadata: ET.Element | None = None
+    for _, node in ET.iterparse(io.BytesIO(data), events=("end",)):
+        if local_name(node.tag) == "metadata":
+            metadata = node
+            break
+
+    # One pass over <metadata>'s children instead of a separate lookup per field.
+    nodes = {local_name(c.tag): c for c in metadata} if metadata is not None else {}
+
+    def txt(node: ET.Element | None) -> str:
         return (node.text or "").strip() if node is not None and node.text else ""
 
-    meta_prefix = ".//{*}metadata/"
-    project_url = txt(meta_prefix + "{*}projectUrl")
-    license_expr = txt(meta_prefix + "{*}license")
-    license_url = txt(meta_prefix + "{*}licenseUrl")
+    lic = nodes.get("license")
+    project_url = txt(nodes.get("projectUrl"))
+    license_expr = txt(lic)
+    license_url = txt(nodes.get("licenseUrl"))
 
     license_name = license_expr or "UNKNOWN"
-    if license_expr and root.find(meta_prefix + "{*}license") is not None:
-        lic = root.find(meta_prefix + "{*}license")
-        if lic is not None and lic.attrib.get("type", "").lower() == "expression":
-            license_name = f"SPDX: {license_expr}"
-        elif lic is not None and lic.attrib.get("type", "").lower() == "file":
-            license_name = f"License file: {license_expr}"
+    license_type = lic.attrib.get("type", "").lower() if license_expr and lic is not None else ""
+    if license_type == "expression":
+        license_name = f"SPDX: {license_expr}"
+    elif license_type == "file":
+        license_name = f"License file: {license_expr}"
 
     return {
         "license_name": license_name,
@@ -95,6 +196,41 @@ def fetch_nuspec_metadata(package_id: str, version: str) -> dict[str, str]:
     }
 
 
+# Failures raise and are therefore not memoized, so a later call retries the fetch.
+@functools.lru_cache(maxsize=None)
+def load_nuspec_metadata(package_l: str, version_l: str) -> dict[str, str]:
+    # Published nuspecs are immutable per (id, version), so the raw document can be cached forever;
+    # metadata is re-derived from it on every run so changes to the parsing take effect.
+    cache_file = CACHE_DIR / f"{package_l}_{version_l}.nuspec"
+    try:
+        return parse_nuspec_metadata(cache_file.read_bytes())
+    except (OSError, ET.ParseError):
+        pass
+
+    data = nuget_get(f"/v3-flatcontainer/{package_l}/{version_l}/{package_l}.nuspec")
+    # Parse before caching so a bogus 200 (proxy login page, truncated body) is never persisted.
+    meta = parse_nuspec_metadata(data)
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, cache_file)
+    return meta
+
+
+def fetch_nuspec_metadata(package_id: str, version: str) -> dict[str, str]:
+    try:
+        # NuGet ids and versions are case-insensitive; normalise before hitting the memo.
+        return load_nuspec_metadata(package_id.lower(), version.lower())
+    except Exception:  # network failures and unparseable nuspecs alike
+        return {
+            "license_name": "UNKNOWN",
+            "license_url": "",
+            "homepage": "",
+            "notes": "Unable to fetch nuspec metadata from nuget.org in this environment.",
+        }
+
+
 def detect_bundled_components(root: Path) -> list[Component]:
     third_party = root / "third_party"
     if not third_party.exists():
@@ -119,14 +255,14 @@ def detect_bundled_components(root: Path) -> list[Component]:
 
 
 def safe_file_name(value: str) -> str:
-    return re.sub(r"[^A-Za-z0-9._-]+", "_", value)
+    return UNSAFE_FILE_NAME_CHARS.sub("_", value)
 
 
-def write_license_file(component: Component, out_dir: Path, root: Path) -> None:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    file_name = f"{component.source}_{safe_file_name(component.name)}_{safe_file_name(component.version)}.txt"
-    out = out_dir / file_name
+def license_file_name(component: Component) -> str:
+    return f"{component.source}_{safe_file_name(component.name)}_{safe_file_name(component.version)}.txt"
 
+
+def render_license_file(component: Component, root: Path) -> list[bytes | memoryview]:
     lines = [
         f"Component: {component.name}",
         f"Version: {component.version}",
@@ -139,23 +275,97 @@ def write_license_file(component: Component, out_dir: Path, root: Path) -> None:
     if component.notes:
         lines.append(f"Notes: {component.notes}")
 
+    # Kept as separate sections so the bundled license text is never concatenated into the header.
+    sections: list[bytes | memoryview] = ["\n".join(lines).encode("utf-8")]
     if component.source == "Bundled":
         bundled_dir = root / "third_party" / component.name
         lic_file = next((bundled_dir / n for n in LICENSE_FILE_CANDIDATES if (bundled_dir / n).exists()), None)
         if lic_file:
-            lines.extend(["", "----- Bundled license text -----", ""])
-            lines.append(lic_file.read_text(encoding="utf-8", errors="replace"))
+            sections.append(b"\n\n----- Bundled license text -----\n\n")
+            # Kept as bytes; re-encoding valid UTF-8 would only cost a copy. Invalid input is repaired and
+            # newlines are normalised to LF, as read_text() did, so records are UTF-8 on every platform.
+            text = lic_file.read_bytes()
+            try:
+                text.decode("utf-8")
+            except UnicodeDecodeError:
+                text = text.decode("utf-8", errors="replace").encode("utf-8")
+            if b"\r" in text:
+                text = text.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            sections.append(text)
+
+    # Match str.rstrip() on the joined text: trim the tail, dropping sections that end up empty.
+    last = rstrip_utf8(sections.pop())
+    while not last and sections:
+        last = rstrip_utf8(sections.pop())
+    sections.extend([last, b"\n"])
+    return sections
+
+
+def rstrip_utf8(data: bytes) -> bytes | memoryview:
+    # Trim through a view so a large license text is not copied again.
+    end = len(data)
+    while end and data[end - 1] in STR_WHITESPACE_BYTES:
+        end -= 1
+    if end and data[end - 1] >= 0x80:
+        # The tail may be non-ASCII whitespace (NBSP, ideographic space, ...), which only str.rstrip() knows.
+        return data[:end].decode("utf-8").rstrip().encode("utf-8")
+    return memoryview(data)[:end]
+
+
+def same_content(data: bytes | None, chunks: list[bytes | memoryview]) -> bool:
+    if data is None or len(data) != sum(len(c) for c in chunks):
+        return False
+    view = memoryview(data)
+    offset = 0
+    for chunk in chunks:
+        if view[offset:offset + len(chunk)] != chunk:
+            return False
+        offset += len(chunk)
+    return True
+
+
+def write_chunks(path: Path, chunks: list[bytes | memoryview]) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        total = sum(len(c) for c in chunks)
+        written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+        # writev may stop short, and does not exist on Windows; finish with plain writes.
+        if written < total:
+            rest = memoryview(b"".join(chunks))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+    finally:
+        os.close(fd)
+
+
+def write_license_files(components: list[Component], out_dir: Path, root: Path) -> None:
+    new_contents = {license_file_name(c): render_license_file(c, root) for c in components}
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    existing = {p.name: p.read_bytes() for p in out_dir.glob("*.txt")}
 
-    out.write_text("\n".join(lines).rstrip() + "\n", encoding="utf-8")
+    # Delete stale records first: on case-insensitive filesystems a record renamed only in case
+    # would otherwise be overwritten under its old name and then removed as stale.
+    for name in existing.keys() - new_contents.keys():
+        (out_dir / name).unlink()
+    # Only touch files whose content actually changed so no-op runs do no writes.
+    for name, chunks in new_contents.items():
+        if not same_content(existing.get(name), chunks):
+            write_chunks(out_dir / name, chunks)
 
 
 def generate(root: Path) -> None:
     root = root.resolve()
     packages = read_csproj_packages(root)
 
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as ex:
+            metas = list(ex.map(lambda pv: fetch_nuspec_metadata(*pv), packages))
+    finally:
+        close_connections()
+
     components: list[Component] = []
-    for package_id, version in packages:
-        meta = fetch_nuspec_metadata(package_id, version)
+    for (package_id, version), meta in zip(packages, metas):
         components.append(
             Component(
                 name=package_id,
@@ -171,13 +381,7 @@ def generate(root: Path) -> None:
     components.extend(detect_bundled_components(root))
     components = sorted(components, key=lambda c: (c.source, c.name.lower(), c.version))
 
-    if LICENSES_DIR.exists():
-        for f in LICENSES_DIR.glob("*.txt"):
-            f.unlink()
-    LICENSES_DIR.mkdir(parents=True, exist_ok=True)
-
-    for comp in components:
-        write_license_file(comp, LICENSES_DIR, root)
+    write_license_files(components, LICENSES_DIR, root)
 
     lines = [
         "# THIRD_PARTY_NOTICES",
@@ -202,7 +406,8 @@ def generate(root: Path) -> None:
         "Detailed records are written to the `LICENSES/` directory.",
     ])
 
-    NOTICE_PATH.write_text("\n".join(lines).rstrip() + "\n", encoding="utf-8")
+    # Encode once and write bytes so the output is LF on every platform.
+    NOTICE_PATH.write_bytes(("\n".join(lines).rstrip() + "\n").encode("utf-8"))
 
 
 def main() -> int: